@@ -6,23 +6,29 @@
 
 import os
 import sys
+import json
 import subprocess
 import signal
 import time
+import importlib.util
+import urllib.request
+import urllib.error
 from pathlib import Path
 
+# 记录进程拉起时间，服务端据此计算冷启动耗时
+os.environ.setdefault("VIKA_SERVICE_LAUNCH_TS", str(time.time()))
+
+REQUIRED_MODULES = ["fastapi", "uvicorn", "astral_vika"]
+
 def check_dependencies():
-    """检查依赖是否已安装"""
-    try:
-        import fastapi
-        import uvicorn
-        import astral_vika
-        print("成功: 所有依赖已安装")
-        return True
-    except ImportError as e:
-        print(f"错误: 缺少依赖: {e}")
+    """检查依赖是否已安装（只查找模块，不实际导入，避免拖慢启动）"""
+    missing = [name for name in REQUIRED_MODULES if importlib.util.find_spec(name) is None]
+    if missing:
+        print(f"错误: 缺少依赖: {', '.join(missing)}")
         print("请运行: pip install -r requirements.txt")
         return False
+    print("成功: 所有依赖已安装")
+    return True
 
 def install_dependencies():
     """安装依赖"""
@@ -60,6 +66,72 @@ def start_service(host="127.0.0.1", port=5001, reload=False):
         print(f"启动服务失败: {e}")
         sys.exit(1)
 
+def _http_get(url, timeout=2.0):
+    """发送GET请求，返回 (状态码, JSON内容)，连接失败时返回 (None, None)"""
+    try:
+        with urllib.request.urlopen(url, timeout=timeout) as resp:
+            return resp.status, json.loads(resp.read().decode("utf-8"))
+    except urllib.error.HTTPError as e:
+        return e.code, json.loads(e.read().decode("utf-8") or "null")
+    except (urllib.error.URLError, ConnectionError, OSError):
+        return None, None
+
+def run_benchmark(host="127.0.0.1", port=5011, runs=3, timeout=60.0):
+    """
+    冷启动基准：反复拉起服务子进程，记录端口可用、SDK预热完成以及首个业务请求的耗时。
+    服务端上报的导入耗时取自 /ready 的 startup 字段；首个业务请求为需要客户端的 GET /spaces，
+    仅在设置了 VIKA_USER_TOKEN 时测量。
+    """
+    base = f"http://{host}:{port}"
+    results = []
+    for i in range(runs):
+        env = dict(os.environ, VIKA_SERVICE_LAUNCH_TS=str(time.time()))
+        t0 = time.perf_counter()
+        proc = subprocess.Popen(
+            [sys.executable, str(Path(__file__).resolve()), "--host", host, "--port", str(port), "--no-install"],
+            env=env,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL
+        )
+        run = {"run": i + 1, "health_seconds": None, "ready_seconds": None,
+               "sdk_import_seconds": None, "first_request_seconds": None}
+        try:
+            deadline = t0 + timeout
+            while time.perf_counter() < deadline and run["health_seconds"] is None:
+                status, _ = _http_get(f"{base}/health")
+                if status == 200:
+                    run["health_seconds"] = round(time.perf_counter() - t0, 4)
+                else:
+                    time.sleep(0.02)
+
+            ready_body = None
+            while time.perf_counter() < deadline:
+                status, ready_body = _http_get(f"{base}/ready")
+                if status == 200 or (ready_body and ready_body.get("prewarm_complete")):
+                    run["ready_seconds"] = round(time.perf_counter() - t0, 4)
+                    break
+                time.sleep(0.02)
+            if ready_body:
+                run["ready"] = ready_body.get("ready")
+                run["server_startup"] = ready_body.get("startup")
+                run["sdk_import_seconds"] = (ready_body.get("startup") or {}).get("sdk_import_seconds")
+
+            if run.get("ready") and os.environ.get("VIKA_USER_TOKEN"):
+                t1 = time.perf_counter()
+                _http_get(f"{base}/spaces", timeout=timeout)
+                run["first_request_seconds"] = round(time.perf_counter() - t1, 4)
+        finally:
+            proc.send_signal(signal.SIGINT)
+            try:
+                proc.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+        results.append(run)
+        print(json.dumps(run, ensure_ascii=False))
+
+    print(json.dumps({"runs": results}, ensure_ascii=False, indent=2))
+    return results
+
 def main():
     """主函数"""
     import argparse
@@ -69,6 +141,13 @@ def main():
     parser.add_argument("--port", type=int, default=5001, help="监听端口")
     parser.add_argument("--reload", action="store_true", help="开发模式，自动重载")
     parser.add_argument("--install-deps", action="store_true", help="安装依赖")
+    parser.add_argument("--no-install", action="store_true",
+                        default=os.environ.get("VIKA_SERVICE_NO_INSTALL") == "1",
+                        help="快速启动：缺少依赖时直接退出，运行时从不调用pip")
+    parser.add_argument("--benchmark", action="store_true", help="运行冷启动基准测试")
+    parser.add_argument("--benchmark-runs", type=int, default=3, help="冷启动基准测试次数")
+    parser.add_argument("--benchmark-port", type=int, default=5011,
+                        help="冷启动基准测试使用的端口，避免与正在运行的服务冲突")
     
     args = parser.parse_args()
     
@@ -76,11 +155,17 @@ def main():
     script_dir = Path(__file__).parent
     os.chdir(script_dir)
     
+    if args.benchmark:
+        run_benchmark(args.host, args.benchmark_port, args.benchmark_runs)
+        return
+    
     if args.install_deps:
         if not install_dependencies():
             sys.exit(1)
     
     if not check_dependencies():
+        if args.no_install:
+            sys.exit(1)
         print("尝试自动安装依赖...")
         if not install_dependencies():
             sys.exit(1)
@@ -6,26 +6,58 @@
 """
 
 import asyncio
+import bisect
+import cProfile
+import hashlib
+import heapq
+import io
 import json
+import marshal
+import math
 import os
+import pstats
+import re
+import sys
+import threading
 import time
-from typing import Dict, List, Optional, Any
-from fastapi import FastAPI, HTTPException, Depends, BackgroundTasks
+import uuid
+from array import array
+from collections import Counter, deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, List, Optional, Any, TYPE_CHECKING
+
+# 启动计时起点（在导入重量级依赖之前）
+_module_t0 = time.perf_counter()
+
+from fastapi import FastAPI, HTTPException, Depends, BackgroundTasks, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, StreamingResponse
 from pydantic import BaseModel
-import uvicorn
-from astral_vika import Vika
-from astral_vika.datasheet.record import Record
 import logging
 
+if TYPE_CHECKING:
+    from astral_vika import Vika
+else:
+    # astral_vika 导入较慢，运行时延迟到预热或首次配置时再导入，见 _load_vika_sdk
+    Vika = Any
+
 # 配置日志
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+class TracedJSONResponse(JSONResponse):
+    """默认响应类，记录JSON序列化耗时"""
+
+    def render(self, content: Any) -> bytes:
+        with trace_span("serialize"):
+            return super().render(content)
+
 app = FastAPI(
     title="维格表API服务",
     description="为SimpleA2A系统提供维格表操作的微服务",
-    version="1.0.0"
+    version="1.0.0",
+    default_response_class=TracedJSONResponse
 )
 
 # 添加CORS支持
@@ -38,11 +70,66 @@ app.add_middleware(
 )
 
 # 全局变量
-vika_client: Optional[Vika] = None
+vika_client: Optional["Vika"] = None
 config: Dict[str, Any] = {}
 cache: Dict[str, Dict[str, Any]] = {}
 rate_limiter: Dict[str, List[float]] = {}
 
+# 变更流: 每个数据表保留有限数量的记录级变更事件
+CHANGE_FEED_RETENTION = int(os.environ.get("VIKA_CHANGE_FEED_RETENTION", 1000))
+# 服务实例标识，进程重启后版本号从0开始，消费方据此判断是否需要全量重载
+feed_epoch: str = uuid.uuid4().hex
+change_feeds: Dict[str, Dict[str, Any]] = {}
+# 最近一次全量拉取时每条记录的摘要，用于刷新时检测差异
+record_digests: Dict[str, Dict[str, str]] = {}
+
+# 全文检索: 每个数据表一个倒排索引，由变更流增量维护；
+# 与构建所用快照同样在 SEARCH_INDEX_MAX_AGE 秒后过期，届时重新构建以反映上游的直接修改
+SEARCH_INDEX_MAX_AGE = 300
+search_indexes: Dict[str, "SearchIndex"] = {}
+
+# 冷启动指标与就绪状态
+_vika_sdk: Optional[type] = None
+prewarm_complete: bool = False
+# 事件循环只弱引用任务，需保留引用以免预热任务在完成前被回收
+_prewarm_task: Optional[asyncio.Task] = None
+# 不随请求取消而中断的上游写入任务（同样需要保留引用）
+_shielded_writes: set = set()
+startup_metrics: Dict[str, Any] = {
+    "module_import_seconds": None,
+    "sdk_import_seconds": None,
+    "startup_seconds": None,
+    "first_request": None
+}
+
+# 请求截止时间与取消统计
+# request_deadline: 当前请求的截止时间（time.monotonic()），由 X-Deadline-Ms 请求头设置
+# request_usage: 当前请求的上游调用计数与耗时分段（spans）
+request_deadline: ContextVar[Optional[float]] = ContextVar("request_deadline", default=None)
+request_usage: ContextVar[Optional[Dict[str, Any]]] = ContextVar("request_usage", default=None)
+inflight_calls: Dict[str, Dict[str, Any]] = {}
+avg_upstream_calls: Dict[str, float] = {}
+cancellation_stats: Dict[str, Any] = {
+    "deadline_exceeded": 0,
+    "client_disconnects": 0,
+    "shared_kept_alive": 0,
+    "upstream_calls_saved_estimate": 0.0,
+    "by_endpoint": {}
+}
+
+# 慢请求日志: 超过阈值的请求连同耗时分段保存在有界环形缓冲区中
+SLOW_REQUEST_THRESHOLD_MS = float(os.environ.get("VIKA_SLOW_REQUEST_MS", 1000))
+SLOW_REQUEST_BUFFER_SIZE = int(os.environ.get("VIKA_SLOW_REQUEST_BUFFER", 100))
+# 单个请求最多保留的分段数，超出部分只计入汇总
+MAX_SPANS_PER_REQUEST = 200
+# 长轮询/SSE 端点按设计就会长时间挂起，不记入慢请求日志
+SLOW_LOG_EXEMPT_ENDPOINTS = {"get_changes"}
+slow_requests: deque = deque(maxlen=SLOW_REQUEST_BUFFER_SIZE)
+slow_request_config: Dict[str, float] = {"threshold_ms": SLOW_REQUEST_THRESHOLD_MS}
+
+# 按需性能剖析会话（cProfile 或采样）
+profile_session: Dict[str, Any] = {"running": False, "result": None}
+
 # Pydantic模型
 class VikaConfig(BaseModel):
     user_token: str
@@ -73,6 +160,12 @@ class RecordQuery(BaseModel):
 class BatchOperation(BaseModel):
     operations: List[Dict[str, Any]]
 
+class UpsertRequest(BaseModel):
+    key_field: str
+    rows: List[Dict[str, Any]]
+    delete_missing: bool = False
+    dry_run: bool = False
+
 # 依赖注入
 async def get_vika_client() -> Vika:
     """获取维格表客户端实例"""
@@ -85,27 +178,28 @@ async def rate_limit_check(operation: str = "default"):
     """QPS限制检查"""
     global rate_limiter, config
     
-    current_time = time.time()
-    qps_limit = config.get('rate_limit_qps', 2)
-    
-    if operation not in rate_limiter:
-        rate_limiter[operation] = []
-    
-    # 清理1秒前的记录
-    rate_limiter[operation] = [
-        t for t in rate_limiter[operation] 
-        if current_time - t < 1.0
-    ]
-    
-    # 检查是否超过QPS限制
-    if len(rate_limiter[operation]) >= qps_limit:
-        raise HTTPException(
-            status_code=429, 
-            detail=f"请求频率超限，当前限制: {qps_limit} QPS"
-        )
-    
-    # 记录当前请求时间
-    rate_limiter[operation].append(current_time)
+    with trace_span("rate_limit"):
+        current_time = time.time()
+        qps_limit = config.get('rate_limit_qps', 2)
+        
+        if operation not in rate_limiter:
+            rate_limiter[operation] = []
+        
+        # 清理1秒前的记录
+        rate_limiter[operation] = [
+            t for t in rate_limiter[operation] 
+            if current_time - t < 1.0
+        ]
+        
+        # 检查是否超过QPS限制
+        if len(rate_limiter[operation]) >= qps_limit:
+            raise HTTPException(
+                status_code=429, 
+                detail=f"请求频率超限，当前限制: {qps_limit} QPS"
+            )
+        
+        # 记录当前请求时间
+        rate_limiter[operation].append(current_time)
 
 def get_cache_key(operation: str, **kwargs) -> str:
     """生成缓存键"""
@@ -116,27 +210,792 @@ def get_cache_key(operation: str, **kwargs) -> str:
 
 def get_from_cache(key: str, max_age: int = 3600) -> Optional[Any]:
     """从缓存获取数据"""
-    if key in cache:
-        entry = cache[key]
-        if time.time() - entry['timestamp'] < max_age:
-            return entry['data']
-        else:
-            del cache[key]
-    return None
+    with trace_span("cache_lookup", key.split(':')[0]):
+        if key in cache:
+            entry = cache[key]
+            if time.time() - entry['timestamp'] < max_age:
+                return entry['data']
+            else:
+                del cache[key]
+        return None
 
-def set_cache(key: str, data: Any):
-    """设置缓存"""
+def set_cache(key: str, data: Any, timestamp: Optional[float] = None):
+    """设置缓存；timestamp 用于在原地更新数据时保留原有的过期时间"""
     cache[key] = {
         'data': data,
-        'timestamp': time.time()
+        'timestamp': time.time() if timestamp is None else timestamp
     }
 
+def full_snapshot_key(datasheet_id: str) -> str:
+    """数据表全量、未过滤快照的缓存键"""
+    return get_cache_key(
+        "records_all",
+        datasheet_id=datasheet_id,
+        view_id=None,
+        filter_formula=None,
+        fields=None
+    )
+
+def _delete_cache_keys(keys: List[str]):
+    """删除缓存条目，由被删除的全量快照构建的全文索引一并丢弃"""
+    for key in keys:
+        cache.pop(key, None)
+    for datasheet_id in list(search_indexes):
+        if full_snapshot_key(datasheet_id) in keys:
+            del search_indexes[datasheet_id]
+
 def clear_cache_pattern(pattern: str):
     """根据模式清除缓存"""
     keys_to_delete = [key for key in cache.keys() if pattern in key]
+    _delete_cache_keys(keys_to_delete)
+    logger.info(f"清除缓存: {len(keys_to_delete)} 条记录, 模式: {pattern}")
+
+def invalidate_datasheet_cache(datasheet_id: str, keep: Optional[str] = None, drop_index: bool = False):
+    """
+    清除某个数据表的记录缓存（全量/视图/过滤快照与单条记录），keep 为需要保留的缓存键。
+    全文索引随变更流更新，只有在写入结果不确定时（drop_index=True）才一并丢弃。
+    """
+    marker = f":datasheet_id={datasheet_id}:"
+    keys_to_delete = [
+        key for key in cache.keys()
+        if marker in key and key.split(":", 1)[0] in ("records_all", "record") and key != keep
+    ]
     for key in keys_to_delete:
         del cache[key]
-    logger.info(f"清除缓存: {len(keys_to_delete)} 条记录, 模式: {pattern}")
+    if drop_index:
+        search_indexes.pop(datasheet_id, None)
+    logger.info(f"清除数据表记录缓存: {datasheet_id}, {len(keys_to_delete)} 条记录")
+
+@contextmanager
+def invalidate_on_failure(datasheet_id: str):
+    """
+    包住上游写入：写入失败或被取消时上游可能已经部分生效，
+    丢弃该表的记录缓存，之后的读取和 upsert 会重新拉取而不是信任过时的快照。
+    """
+    try:
+        yield
+    except BaseException:
+        invalidate_datasheet_cache(datasheet_id, drop_index=True)
+        raise
+
+# 列式快照中表示“该记录没有这个字段”的占位对象
+_MISSING = object()
+
+class RecordSnapshot:
+    """
+    缓存中数据表快照的紧凑列式表示。
+    字段名只保存一份（驻留字符串），每个字段一列值，记录ID通过排序数组做二分索引；
+    只有在序列化响应时才按需还原成 record.to_dict() 格式的字典。
+    """
+
+    __slots__ = ("record_ids", "field_names", "columns", "meta_names", "meta_columns",
+                 "_sorted_ids", "_sorted_rows", "memory", "feed_version")
+
+    def __init__(self, records: List[Dict[str, Any]], feed_version: int = 0):
+        # 构建时数据表变更流的版本号；此后若有写入，快照即不再反映最新状态
+        self.feed_version = feed_version
+        count = len(records)
+        self.record_ids: List[str] = [sys.intern(r.get('recordId') or '') for r in records]
+
+        # 字段列：按首次出现顺序收集字段名
+        field_names: Dict[str, None] = {}
+        for r in records:
+            for name in r.get('fields', {}):
+                if name not in field_names:
+                    field_names[sys.intern(name)] = None
+        self.field_names = tuple(field_names)
+        self.columns: Dict[str, List[Any]] = {name: [_MISSING] * count for name in self.field_names}
+        for row, r in enumerate(records):
+            for name, value in r.get('fields', {}).items():
+                self.columns[name][row] = value
+
+        # 其余元数据（createdAt/updatedAt等）；整数时间戳用 array 存储
+        meta_names: Dict[str, None] = {}
+        for r in records:
+            for name in r:
+                if name not in ('recordId', 'fields') and name not in meta_names:
+                    meta_names[sys.intern(name)] = None
+        self.meta_names = tuple(meta_names)
+        self.meta_columns: Dict[str, Any] = {}
+        for name in self.meta_names:
+            values = [r.get(name, _MISSING) for r in records]
+            if all(type(v) is int for v in values):
+                self.meta_columns[name] = array('q', values)
+            else:
+                self.meta_columns[name] = values
+
+        order = sorted(range(count), key=self.record_ids.__getitem__)
+        self._sorted_ids = [self.record_ids[i] for i in order]
+        self._sorted_rows = array('I', order)
+        self.memory = self._measure(records)
+
+    def __len__(self) -> int:
+        return len(self.record_ids)
+
+    def find_row(self, record_id: str) -> Optional[int]:
+        """按记录ID查找行号"""
+        pos = bisect.bisect_left(self._sorted_ids, record_id)
+        if pos < len(self._sorted_ids) and self._sorted_ids[pos] == record_id:
+            return self._sorted_rows[pos]
+        return None
+
+    def row_fields(self, row: int) -> Dict[str, Any]:
+        """还原某一行的字段字典"""
+        fields = {}
+        for name in self.field_names:
+            value = self.columns[name][row]
+            if value is not _MISSING:
+                fields[name] = value
+        return fields
+
+    def row_dict(self, row: int) -> Dict[str, Any]:
+        """还原某一行为 record.to_dict() 格式"""
+        record = {'recordId': self.record_ids[row], 'fields': self.row_fields(row)}
+        for name in self.meta_names:
+            value = self.meta_columns[name][row]
+            if value is not _MISSING:
+                record[name] = value
+        return record
+
+    def to_dicts(self) -> List[Dict[str, Any]]:
+        """序列化时还原全部记录"""
+        return [self.row_dict(row) for row in range(len(self.record_ids))]
+
+    def apply_changes(self, changes: List[Dict[str, Any]], feed_version: int) -> "RecordSnapshot":
+        """返回应用了记录级变更（create/update/delete）后的新快照"""
+        records = self.to_dicts()
+        positions = {r['recordId']: i for i, r in enumerate(records)}
+        deleted = set()
+        for change in changes:
+            record_id = change['record_id']
+            if change['type'] == 'delete':
+                deleted.add(record_id)
+            elif record_id in positions:
+                records[positions[record_id]] = change['record']
+            else:
+                positions[record_id] = len(records)
+                records.append(change['record'])
+        return RecordSnapshot([r for r in records if r['recordId'] not in deleted], feed_version)
+
+    def _measure(self, records: List[Dict[str, Any]]) -> Dict[str, Any]:
+        """
+        对比两种表示的容器开销（字段值对象两边共享，不计入）。
+        字典表示：每条记录的外层字典、fields字典以及互不相同的键字符串；
+        列式表示：各列列表、记录ID列表和索引数组。
+        """
+        dict_bytes = sys.getsizeof(records)
+        seen_keys = set()
+        for r in records:
+            dict_bytes += sys.getsizeof(r) + sys.getsizeof(r.get('fields', {}))
+            for container in (r, r.get('fields', {})):
+                for key in container:
+                    if id(key) not in seen_keys:
+                        seen_keys.add(id(key))
+                        dict_bytes += sys.getsizeof(key)
+
+        compact_bytes = (
+            sys.getsizeof(self.record_ids) + sys.getsizeof(self._sorted_ids)
+            + sys.getsizeof(self._sorted_rows) + sys.getsizeof(self.columns)
+            + sys.getsizeof(self.meta_columns)
+            + sum(sys.getsizeof(name) for name in self.field_names + self.meta_names)
+            + sum(sys.getsizeof(col) for col in self.columns.values())
+            + sum(sys.getsizeof(col) for col in self.meta_columns.values())
+        )
+        return {
+            "rows": len(records),
+            "dict_overhead_bytes": dict_bytes,
+            "compact_overhead_bytes": compact_bytes,
+            "saved_bytes": dict_bytes - compact_bytes
+        }
+
+# 中日韩统一表意文字（含扩展A区和兼容区）
+_CJK_RE = re.compile(r'[\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff]+')
+# 非中文部分按“字母/数字串”切词
+_WORD_RE = re.compile(r'[^\W_\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff]+')
+# 关联字段中的记录ID不参与检索
+_RECORD_ID_RE = re.compile(r'^rec[0-9A-Za-z]{10}$')
+
+def tokenize(text: str, for_query: bool = False) -> List[str]:
+    """
+    中文按字二元组切分，其他文字按词切分（小写）。
+    建索引时额外保留中文单字，便于单字查询；查询时连续中文只取二元组。
+    """
+    tokens = []
+    for run in _CJK_RE.findall(text):
+        if len(run) == 1 or not for_query:
+            tokens.extend(run)
+        tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+    tokens.extend(word.lower() for word in _WORD_RE.findall(text))
+    return tokens
+
+def _searchable_text(value: Any) -> Optional[str]:
+    """提取字段值中可检索的文本，非文本字段返回None"""
+    if isinstance(value, str):
+        return None if _RECORD_ID_RE.match(value) else value
+    if isinstance(value, list):
+        parts = [v for v in value if isinstance(v, str) and not _RECORD_ID_RE.match(v)]
+        return " ".join(parts) if parts else None
+    return None
+
+class SearchIndex:
+    """
+    单个数据表文本字段的倒排索引，使用BM25打分。
+    由缓存中的全量快照构建，之后通过 publish_changes 的记录级事件增量更新，不访问上游。
+    """
+
+    K1 = 1.2
+    B = 0.75
+
+    def __init__(self):
+        self.postings: Dict[str, Dict[str, int]] = {}
+        self.doc_terms: Dict[str, Dict[str, int]] = {}
+        self.doc_lengths: Dict[str, int] = {}
+        self.texts: Dict[str, Dict[str, str]] = {}
+        self.total_length = 0
+        self.built_at = time.time()
+        self.updated_at = self.built_at
+        # 构建所用快照的缓存时间，决定索引何时过期
+        self.snapshot_timestamp = self.built_at
+
+    @classmethod
+    def from_snapshot(cls, snapshot: "RecordSnapshot") -> "SearchIndex":
+        index = cls()
+        for row in range(len(snapshot)):
+            index.add(snapshot.record_ids[row], snapshot.row_fields(row))
+        return index
+
+    def add(self, record_id: str, fields: Dict[str, Any]):
+        """添加（或替换）一条记录"""
+        if record_id in self.doc_terms:
+            self.remove(record_id)
+        texts = {}
+        terms: Dict[str, int] = {}
+        for name, value in fields.items():
+            text = _searchable_text(value)
+            if not text:
+                continue
+            texts[name] = text
+            for token in tokenize(text):
+                terms[token] = terms.get(token, 0) + 1
+        if not terms:
+            return
+        self.texts[record_id] = texts
+        self.doc_terms[record_id] = terms
+        length = sum(terms.values())
+        self.doc_lengths[record_id] = length
+        self.total_length += length
+        for token, tf in terms.items():
+            self.postings.setdefault(token, {})[record_id] = tf
+        self.updated_at = time.time()
+
+    def remove(self, record_id: str):
+        """移除一条记录"""
+        terms = self.doc_terms.pop(record_id, None)
+        if terms is None:
+            return
+        self.texts.pop(record_id, None)
+        self.total_length -= self.doc_lengths.pop(record_id, 0)
+        for token in terms:
+            docs = self.postings.get(token)
+            if docs is not None:
+                docs.pop(record_id, None)
+                if not docs:
+                    del self.postings[token]
+        self.updated_at = time.time()
+
+    def apply(self, change: Dict[str, Any]):
+        """应用变更流中的一个记录级事件"""
+        if change['type'] == 'delete':
+            self.remove(change['record_id'])
+        elif change.get('record') is not None:
+            self.add(change['record_id'], change['record'].get('fields', {}))
+
+    def search(self, query: str, limit: int = 20, fields: Optional[List[str]] = None) -> Dict[str, Any]:
+        """
+        检索并按BM25排序。优先返回包含全部查询词的记录，没有时退化为包含任一查询词；
+        原文中完整出现查询串的记录额外加分。
+        """
+        tokens = list(dict.fromkeys(tokenize(query, for_query=True)))
+        if not tokens or not self.doc_terms:
+            return {"tokens": tokens, "total": 0, "partial": False, "results": []}
+
+        postings = sorted((self.postings.get(t, {}) for t in tokens), key=len)
+        candidates = set(postings[0])
+        for docs in postings[1:]:
+            candidates &= docs.keys()
+            if not candidates:
+                break
+        partial = False
+        if not candidates:
+            candidates = set().union(*postings)
+            partial = bool(candidates)
+
+        doc_count = len(self.doc_terms)
+        avg_length = self.total_length / doc_count
+        needle = query.strip().lower()
+        scored = []
+        for record_id in candidates:
+            texts = self.texts.get(record_id, {})
+            if fields:
+                texts = {k: v for k, v in texts.items() if k in fields}
+                if not texts:
+                    continue
+            length = self.doc_lengths[record_id]
+            score = 0.0
+            for token in tokens:
+                docs = self.postings.get(token)
+                tf = docs.get(record_id) if docs else None
+                if not tf:
+                    continue
+                idf = math.log(1 + (doc_count - len(docs) + 0.5) / (len(docs) + 0.5))
+                score += idf * tf * (self.K1 + 1) / (tf + self.K1 * (1 - self.B + self.B * length / avg_length))
+            scored.append((score, record_id, texts))
+
+        # 只对BM25靠前的一批候选检查完整短语，避免高频词查询时逐条扫描原文
+        top = heapq.nlargest(max(limit * 5, 50), scored, key=lambda item: item[0])
+        ranked = []
+        for score, record_id, texts in top:
+            matched = [k for k, v in texts.items() if needle and needle in v.lower()]
+            if matched:
+                score *= 1.5
+            ranked.append((score, record_id, matched))
+        ranked.sort(key=lambda item: (-item[0], item[1]))
+        return {
+            "tokens": tokens,
+            "total": len(scored),
+            "partial": partial,
+            "results": [
+                {"record_id": record_id, "score": round(score, 4), "matched_fields": matched}
+                for score, record_id, matched in ranked[:limit]
+            ]
+        }
+
+def _get_change_feed(datasheet_id: str) -> Dict[str, Any]:
+    """获取（必要时创建）数据表的变更流"""
+    feed = change_feeds.get(datasheet_id)
+    if feed is None:
+        feed = {
+            'version': 0,
+            'events': deque(maxlen=CHANGE_FEED_RETENTION),
+            'notify': asyncio.Event()
+        }
+        change_feeds[datasheet_id] = feed
+    return feed
+
+def _record_digest(record: Dict[str, Any]) -> str:
+    """计算记录字段内容的摘要"""
+    payload = json.dumps(record.get('fields', {}), sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.md5(payload.encode('utf-8')).hexdigest()
+
+def publish_changes(datasheet_id: str, changes: List[Dict[str, Any]], source: str = "write"):
+    """
+    发布记录级变更事件。
+    :param datasheet_id: 数据表ID
+    :param changes: 变更列表，每项包含 type(create/update/delete)、record_id 和可选的 record
+    :param source: 变更来源，write 表示本服务的写操作，refresh 表示刷新时检测到的差异
+    """
+    if not changes:
+        return
+    feed = _get_change_feed(datasheet_id)
+    digests = record_digests.get(datasheet_id)
+    now = time.time()
+    for change in changes:
+        feed['version'] += 1
+        record = change.get('record')
+        feed['events'].append({
+            'version': feed['version'],
+            'type': change['type'],
+            'record_id': change['record_id'],
+            'record': record,
+            'source': source,
+            'timestamp': now
+        })
+        # 同步摘要，避免下一次刷新把本服务自己的写操作再报告一遍
+        if digests is not None and source == "write":
+            if change['type'] == 'delete':
+                digests.pop(change['record_id'], None)
+            elif record is not None:
+                digests[change['record_id']] = _record_digest(record)
+    # 增量更新全文索引
+    index = search_indexes.get(datasheet_id)
+    if index is not None:
+        for change in changes:
+            index.apply(change)
+    # 唤醒所有等待中的订阅者，并为下一轮等待换上新的事件对象
+    feed['notify'].set()
+    feed['notify'] = asyncio.Event()
+
+def detect_snapshot_changes(datasheet_id: str, records: List[Dict[str, Any]]):
+    """将全量拉取的结果与上一次的摘要比较，发布检测到的差异"""
+    new_digests = {r['recordId']: _record_digest(r) for r in records if r.get('recordId')}
+    old_digests = record_digests.get(datasheet_id)
+    record_digests[datasheet_id] = new_digests
+    if old_digests is None:
+        # 首次拉取只建立基线
+        return
+
+    changes = []
+    for record in records:
+        record_id = record.get('recordId')
+        if record_id not in new_digests:
+            continue
+        old = old_digests.get(record_id)
+        if old is None:
+            changes.append({'type': 'create', 'record_id': record_id, 'record': record})
+        elif old != new_digests[record_id]:
+            changes.append({'type': 'update', 'record_id': record_id, 'record': record})
+    for record_id in old_digests.keys() - new_digests.keys():
+        changes.append({'type': 'delete', 'record_id': record_id, 'record': None})
+
+    if changes:
+        logger.info(f"刷新检测到变更: {datasheet_id}, 数量: {len(changes)}")
+        publish_changes(datasheet_id, changes, source="refresh")
+
+def get_changes_since(datasheet_id: str, since: int, epoch: Optional[str] = None) -> Dict[str, Any]:
+    """
+    获取指定版本之后的变更。
+    当 epoch 与当前服务实例不一致（服务已重启）、请求的版本早于保留窗口或晚于当前版本时
+    返回 reset=True，消费方应执行一次全量重载。
+    """
+    feed = _get_change_feed(datasheet_id)
+    events = feed['events']
+    oldest = events[0]['version'] if events else feed['version'] + 1
+    reset = (
+        (epoch is not None and epoch != feed_epoch)
+        or since > feed['version']
+        or since < oldest - 1
+    )
+    return {
+        'epoch': feed_epoch,
+        'version': feed['version'],
+        'reset': reset,
+        'events': [] if reset else [e for e in events if e['version'] > since]
+    }
+
+_UPSTREAM_SEND_RE = re.compile(r"正在向 (\S+) 发送 (\w+) 请求")
+_UPSTREAM_DONE_RE = re.compile(r"成功接收到来自 (\S+) 的响应")
+
+def _new_request_usage() -> Dict[str, Any]:
+    """创建单个请求的统计上下文"""
+    return {
+        "upstream_calls": 0,
+        "t0": time.perf_counter(),
+        "spans": [],
+        "span_totals": {},
+        "pending_upstream": {},
+        "shared_kept_alive": False
+    }
+
+def _add_span(usage: Dict[str, Any], name: str, start: float, end: float, detail: Optional[str] = None):
+    """记录一个耗时分段"""
+    duration_ms = (end - start) * 1000
+    totals = usage["span_totals"]
+    totals[name] = totals.get(name, 0.0) + duration_ms
+    if len(usage["spans"]) < MAX_SPANS_PER_REQUEST:
+        span = {
+            "name": name,
+            "start_ms": round((start - usage["t0"]) * 1000, 2),
+            "duration_ms": round(duration_ms, 2)
+        }
+        if detail:
+            span["detail"] = detail
+        usage["spans"].append(span)
+
+@contextmanager
+def trace_span(name: str, detail: Optional[str] = None):
+    """在当前请求中记录一段代码的耗时；不在请求上下文中时不做任何事"""
+    usage = request_usage.get()
+    if usage is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        _add_span(usage, name, start, time.perf_counter(), detail)
+
+async def _on_upstream_status(message: str):
+    """SDK状态回调：在每次向维格表发起请求前后触发，用于统计上游调用次数和耗时"""
+    usage = request_usage.get()
+    if usage is None:
+        return
+    sent = _UPSTREAM_SEND_RE.search(message)
+    if sent:
+        usage["upstream_calls"] += 1
+        url, method = sent.groups()
+        usage["pending_upstream"].setdefault(url, []).append((time.perf_counter(), method))
+        return
+    done = _UPSTREAM_DONE_RE.search(message)
+    if done:
+        pending = usage["pending_upstream"].get(done.group(1))
+        if pending:
+            start, method = pending.pop(0)
+            _add_span(usage, "upstream", start, time.perf_counter(), f"{method} {done.group(1)}")
+
+def _finish_request_trace(scope, usage: Dict[str, Any], status: Optional[int], cancelled: Optional[str] = None):
+    """请求结束时汇总耗时，超过阈值的写入慢请求日志"""
+    end = time.perf_counter()
+    # 没有收到成功回调的上游调用（失败或被取消）也记入分段
+    for url, pending in usage["pending_upstream"].items():
+        for start, method in pending:
+            _add_span(usage, "upstream", start, end, f"{method} {url} (未完成)")
+    duration_ms = (end - usage["t0"]) * 1000
+    if duration_ms < slow_request_config["threshold_ms"]:
+        return
+    if getattr(scope.get("endpoint"), "__name__", None) in SLOW_LOG_EXEMPT_ENDPOINTS:
+        return
+    slow_requests.append({
+        "timestamp": time.time(),
+        "method": scope.get("method"),
+        "path": scope["path"],
+        "query": scope.get("query_string", b"").decode("latin-1"),
+        "status": status,
+        "cancelled": cancelled,
+        "duration_ms": round(duration_ms, 2),
+        "upstream_calls": usage["upstream_calls"],
+        "span_totals": {k: round(v, 2) for k, v in usage["span_totals"].items()},
+        "spans": usage["spans"]
+    })
+
+def _create_vika_client(vika_cls: type, token: str, api_base: str) -> "Vika":
+    """创建维格表客户端并挂上上游调用统计回调"""
+    return vika_cls(token=token, api_base=api_base, status_callback=_on_upstream_status)
+
+async def run_single_flight(key: str, factory):
+    """
+    合并相同键的并发上游请求，所有等待者共享同一个结果。
+    某个等待者被取消（截止时间到达或客户端断开）时，只要还有其他等待者，
+    共享的上游任务就继续执行；最后一个等待者离开时才真正取消上游任务。
+    """
+    entry = inflight_calls.get(key)
+    if entry is None:
+        async def _run_shared():
+            # 共享任务不受发起者截止时间的约束
+            request_deadline.set(None)
+            return await factory()
+
+        task = asyncio.ensure_future(_run_shared())
+        entry = {"task": task, "waiters": 0}
+        inflight_calls[key] = entry
+
+        def _cleanup(_, key=key, entry=entry):
+            if inflight_calls.get(key) is entry:
+                del inflight_calls[key]
+        task.add_done_callback(_cleanup)
+
+    entry["waiters"] += 1
+    try:
+        return await asyncio.shield(entry["task"])
+    except asyncio.CancelledError:
+        if entry["waiters"] > 1:
+            cancellation_stats["shared_kept_alive"] += 1
+            usage = request_usage.get()
+            if usage is not None:
+                usage["shared_kept_alive"] = True
+        elif not entry["task"].done():
+            entry["task"].cancel()
+        raise
+    finally:
+        entry["waiters"] -= 1
+
+def _record_request_outcome(endpoint: str, upstream_calls: int, cancelled: bool, reason: str = "",
+                            shared_kept_alive: bool = False):
+    """
+    更新每个端点的平均上游调用数（只统计实际访问了上游的请求，缓存命中不计入）；
+    取消时按平均值估算节省的配额，共享任务仍在为其他请求执行时不计节省。
+    """
+    stats = cancellation_stats["by_endpoint"].setdefault(
+        endpoint, {"cancelled": 0, "upstream_calls_saved_estimate": 0.0}
+    )
+    if not cancelled:
+        if upstream_calls > 0:
+            previous = avg_upstream_calls.get(endpoint)
+            avg_upstream_calls[endpoint] = upstream_calls if previous is None else previous * 0.8 + upstream_calls * 0.2
+        return
+    if shared_kept_alive:
+        saved = 0.0
+    else:
+        saved = max(0.0, avg_upstream_calls.get(endpoint, upstream_calls) - upstream_calls)
+    stats["cancelled"] += 1
+    stats["upstream_calls_saved_estimate"] = round(stats["upstream_calls_saved_estimate"] + saved, 2)
+    cancellation_stats["upstream_calls_saved_estimate"] = round(
+        cancellation_stats["upstream_calls_saved_estimate"] + saved, 2
+    )
+    cancellation_stats[reason] += 1
+    logger.info(f"请求已取消: {endpoint}, 原因: {reason}, 已发起上游调用: {upstream_calls}, 估算节省: {saved:.1f}")
+
+def _deadline_allows(delay: float) -> bool:
+    """当前请求的剩余时间是否足够再等待 delay 秒（未设置截止时间时总是允许）"""
+    deadline = request_deadline.get()
+    return deadline is None or time.monotonic() + delay < deadline
+
+def _load_vika_sdk() -> type:
+    """导入并返回 Vika 客户端类（只在第一次调用时真正导入）"""
+    global _vika_sdk
+    if _vika_sdk is None:
+        t0 = time.perf_counter()
+        from astral_vika import Vika as VikaClient
+        startup_metrics["sdk_import_seconds"] = round(time.perf_counter() - t0, 4)
+        _vika_sdk = VikaClient
+    return _vika_sdk
+
+def _seconds_since_launch() -> Optional[float]:
+    """距离启动脚本拉起进程的秒数（由 start_service.py 通过环境变量传入）"""
+    launch_ts = os.environ.get("VIKA_SERVICE_LAUNCH_TS")
+    if not launch_ts:
+        return None
+    try:
+        return round(time.time() - float(launch_ts), 4)
+    except ValueError:
+        return None
+
+async def _prewarm():
+    """后台预热：导入SDK，如环境变量提供了令牌则直接完成配置"""
+    global vika_client, prewarm_complete
+    try:
+        vika_cls = await asyncio.to_thread(_load_vika_sdk)
+        token = os.environ.get("VIKA_USER_TOKEN")
+        if token and vika_client is None:
+            config.setdefault("user_token", token)
+            config.setdefault("api_base", os.environ.get("VIKA_API_BASE", VikaConfig.model_fields["api_base"].default))
+            config.setdefault("rate_limit_qps", int(os.environ.get("VIKA_RATE_LIMIT_QPS", 2)))
+            vika_client = _create_vika_client(vika_cls, config["user_token"], config["api_base"])
+            logger.info("已使用环境变量完成维格表客户端预配置")
+    except Exception as e:
+        logger.error(f"预热失败: {e}")
+    finally:
+        prewarm_complete = True
+        logger.info(f"预热完成, SDK导入耗时: {startup_metrics['sdk_import_seconds']}s")
+
+@app.on_event("startup")
+async def on_startup():
+    """记录启动耗时并在后台预热，不阻塞端口监听"""
+    global _prewarm_task
+    startup_metrics["module_import_seconds"] = round(_module_ready_t - _module_t0, 4)
+    startup_metrics["startup_seconds"] = _seconds_since_launch()
+    _prewarm_task = asyncio.create_task(_prewarm())
+
+@app.middleware("http")
+async def record_first_request(request: Request, call_next):
+    """记录第一个业务请求的延迟，用于冷启动基准"""
+    if startup_metrics["first_request"] is not None or request.url.path in ("/health", "/ready"):
+        return await call_next(request)
+    t0 = time.perf_counter()
+    response = await call_next(request)
+    if startup_metrics["first_request"] is None:
+        startup_metrics["first_request"] = {
+            "path": request.url.path,
+            "latency_seconds": round(time.perf_counter() - t0, 4),
+            "seconds_since_launch": _seconds_since_launch()
+        }
+    return response
+
+class RequestDeadlineMiddleware:
+    """
+    截止时间与断连处理（纯ASGI中间件，放在最外层）。
+    - 请求头 X-Deadline-Ms 给出剩余时间预算（毫秒），到期后取消处理函数并返回504；
+    - 客户端断开连接时取消处理函数，连带取消其中排队的限速等待和上游调用。
+    处理函数被取消时，通过 run_single_flight 共享给其他请求的上游任务不受影响。
+    """
+
+    EXEMPT_PATHS = ("/health", "/ready")
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] in self.EXEMPT_PATHS:
+            await self.app(scope, receive, send)
+            return
+
+        # 先读完请求体，之后由本中间件独占监听 http.disconnect
+        queue: asyncio.Queue = asyncio.Queue()
+        while True:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                return
+            queue.put_nowait(message)
+            if not message.get("more_body"):
+                break
+
+        deadline = None
+        header = dict(scope.get("headers") or []).get(b"x-deadline-ms")
+        if header:
+            try:
+                deadline = time.monotonic() + max(0.0, float(header.decode())) / 1000.0
+            except ValueError:
+                deadline = None
+
+        response_started = False
+        response_complete = False
+        status = None
+
+        async def tracked_send(message):
+            nonlocal response_started, response_complete, status
+            if message["type"] == "http.response.start":
+                response_started = True
+                status = message["status"]
+            elif message["type"] == "http.response.body" and not message.get("more_body"):
+                response_complete = True
+            await send(message)
+
+        async def watch_disconnect():
+            while True:
+                message = await receive()
+                if message["type"] == "http.disconnect":
+                    queue.put_nowait(message)
+                    return
+
+        usage = _new_request_usage()
+        deadline_token = request_deadline.set(deadline)
+        usage_token = request_usage.set(usage)
+        try:
+            app_task = asyncio.ensure_future(self.app(scope, queue.get, tracked_send))
+        finally:
+            request_deadline.reset(deadline_token)
+            request_usage.reset(usage_token)
+        watcher = asyncio.ensure_future(watch_disconnect())
+
+        timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+        try:
+            await asyncio.wait({app_task, watcher}, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+        except asyncio.CancelledError:
+            app_task.cancel()
+            raise
+        finally:
+            watcher.cancel()
+
+        # 未匹配路由（如404）没有 endpoint，不计入按端点的统计，避免统计表随任意路径无限增长
+        endpoint = getattr(scope.get("endpoint"), "__name__", None)
+        if app_task.done() or response_complete:
+            # 响应发送完毕后服务器也会报告 http.disconnect，此时不算取消
+            try:
+                await app_task
+            finally:
+                _finish_request_trace(scope, usage, status)
+            if endpoint is not None:
+                _record_request_outcome(endpoint, usage["upstream_calls"], cancelled=False)
+            return
+
+        reason = "client_disconnects" if watcher.done() and not watcher.cancelled() else "deadline_exceeded"
+        app_task.cancel()
+        try:
+            await app_task
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            logger.warning(f"取消请求时处理函数抛出异常: {e}")
+        if endpoint is not None:
+            _record_request_outcome(endpoint, usage["upstream_calls"], cancelled=True, reason=reason,
+                                    shared_kept_alive=usage["shared_kept_alive"])
+
+        if reason == "deadline_exceeded" and not response_started:
+            status = 504
+            response = JSONResponse(status_code=504, content={"detail": "请求超过截止时间，已取消"})
+            await response(scope, receive, send)
+        _finish_request_trace(scope, usage, status, cancelled=reason)
+
+app.add_middleware(RequestDeadlineMiddleware)
 
 # API端点
 
@@ -150,6 +1009,21 @@ async def health_check():
         "config_loaded": bool(config)
     }
 
+@app.get("/ready")
+async def readiness_check():
+    """就绪检查：配置已加载且预热完成后才返回200，供进程管理器在切流前等待"""
+    ready = prewarm_complete and vika_client is not None
+    return JSONResponse(
+        status_code=200 if ready else 503,
+        content={
+            "ready": ready,
+            "config_loaded": bool(config),
+            "client_initialized": vika_client is not None,
+            "prewarm_complete": prewarm_complete,
+            "startup": startup_metrics
+        }
+    )
+
 @app.post("/config")
 async def set_config(vika_config: VikaConfig):
     """设置维格表配置"""
@@ -158,11 +1032,9 @@ async def set_config(vika_config: VikaConfig):
     try:
         config.update(vika_config.dict())
         
-        # 创建维格表客户端实例
-        vika_client = Vika(
-            token=vika_config.user_token,
-            api_base=vika_config.api_base
-        )
+        # 创建维格表客户端实例（SDK在线程中导入，预热未完成时不阻塞事件循环）
+        vika_cls = await asyncio.to_thread(_load_vika_sdk)
+        vika_client = _create_vika_client(vika_cls, vika_config.user_token, vika_config.api_base)
         
         logger.info("维格表客户端配置成功")
         return {"success": True, "message": "配置成功"}
@@ -195,28 +1067,79 @@ async def create_records(
         
         # 准备记录数据
         records_data = [record.fields for record in request.records]
-        
-        # --- 诊断代码开始 ---
-        logger.info(f"--- 运行时 dir(datasheet.records) ---: {dir(datasheet.records)}")
-        # --- 诊断代码结束 ---
 
         # 调用astral_vika的正确API
-        result = await datasheet.records.acreate(records=records_data)
+        with invalidate_on_failure(request.datasheet_id):
+            result = await datasheet.records.acreate(records=records_data)
         
         # 清除相关缓存
-        clear_cache_pattern(f"records:{request.datasheet_id}")
+        invalidate_datasheet_cache(request.datasheet_id)
+        
+        created = [r.to_dict() for r in result]
+        publish_changes(request.datasheet_id, [
+            {'type': 'create', 'record_id': r.get('recordId'), 'record': r} for r in created
+        ])
         
         logger.info(f"创建记录成功: {request.datasheet_id}, 数量: {len(records_data)}")
         
         return {
             "success": True,
-            "data": [r.to_dict() for r in result]
+            "data": created
         }
         
     except Exception as e:
         logger.error(f"创建记录失败: {e}")
         raise HTTPException(status_code=500, detail=f"创建记录失败: {str(e)}")
 
+def _materialize(snapshot: RecordSnapshot) -> List[Dict[str, Any]]:
+    """将列式快照还原为字典列表（计入序列化耗时）"""
+    with trace_span("serialize", f"{len(snapshot)} records"):
+        return snapshot.to_dicts()
+
+async def fetch_records_snapshot(
+    vika: "Vika",
+    datasheet_id: str,
+    view_id: Optional[str] = None,
+    filter_formula: Optional[str] = None,
+    fields: Optional[str] = None
+) -> RecordSnapshot:
+    """从上游拉取全部记录，生成列式快照并写入缓存"""
+    cache_key = get_cache_key(
+        "records_all",
+        datasheet_id=datasheet_id,
+        view_id=view_id,
+        filter_formula=filter_formula,
+        fields=fields
+    )
+
+    async def fetch_all_records():
+        datasheet = vika.datasheet(datasheet_id)
+        
+        # 构建查询链
+        query = datasheet.records.filter(
+            filter_by_formula=filter_formula,
+            view_id=view_id,
+            fields=fields.split(',') if fields else None
+        )
+        
+        # 使用 .aall() 获取所有记录
+        all_records = await query.aall()
+        
+        # 将记录转换为字典列表
+        records_as_dicts = [record.to_dict() for record in all_records]
+
+        # 仅全量、未过滤的拉取能代表整张表，用它来检测刷新差异
+        if not (view_id or filter_formula or fields):
+            detect_snapshot_changes(datasheet_id, records_as_dicts)
+        
+        # 缓存中保存紧凑的列式快照，响应时再还原为字典
+        snapshot = RecordSnapshot(records_as_dicts, feed_version=_get_change_feed(datasheet_id)['version'])
+        set_cache(cache_key, snapshot)
+        return snapshot
+
+    # 相同查询的并发请求共享同一次上游拉取
+    return await run_single_flight(cache_key, fetch_all_records)
+
 @app.get("/records/{datasheet_id}")
 async def get_records(
     datasheet_id: str,
@@ -230,9 +1153,6 @@ async def get_records(
 ):
     """获取记录列表"""
     try:
-        # 将逗号分隔的字符串转换为列表
-        field_list = fields.split(',') if fields else None
-
         # 生成缓存键 (移除 page_token 和 page_size)
         cache_key = get_cache_key(
             "records_all", # 使用新的缓存键前缀以避免冲突
@@ -247,39 +1167,18 @@ async def get_records(
         if cached_result is not None:
             return {
                 "success": True,
-                "data": cached_result,
+                "data": {"records": _materialize(cached_result), "pageToken": None},
                 "from_cache": True
             }
         
-        datasheet = vika.datasheet(datasheet_id)
-        
-        # 构建查询链
-        query = datasheet.records.filter(
-            filter_by_formula=filter_formula,
-            view_id=view_id,
-            fields=field_list
-        )
+        snapshot = await fetch_records_snapshot(vika, datasheet_id, view_id, filter_formula, fields)
         
-        # 使用 .aall() 获取所有记录
-        all_records = await query.aall()
+        logger.info(f"获取全部记录成功: {datasheet_id}, 数量: {len(snapshot)}")
         
-        # 将记录转换为字典列表
-        records_as_dicts = [record.to_dict() for record in all_records]
-
         # 构建符合要求的返回结构，pageToken 永远为 null
-        result_data = {
-            "records": records_as_dicts,
-            "pageToken": None
-        }
-        
-        # 设置缓存
-        set_cache(cache_key, result_data)
-        
-        logger.info(f"获取全部记录成功: {datasheet_id}, 数量: {len(records_as_dicts)}")
-        
         return {
             "success": True,
-            "data": result_data,
+            "data": {"records": _materialize(snapshot), "pageToken": None},
             "from_cache": False
         }
         
@@ -336,18 +1235,22 @@ async def update_record(
             if 'record_id' in record:
                 record['recordId'] = record.pop('record_id')
         
-        result = await datasheet.records.aupdate(records=update_data)
+        with invalidate_on_failure(datasheet_id):
+            result = await datasheet.records.aupdate(records=update_data)
         
         # 清除相关缓存
-        clear_cache_pattern(f"records:{datasheet_id}")
-        for record in request.records:
-            clear_cache_pattern(f"record:{datasheet_id}:{record.record_id}")
+        invalidate_datasheet_cache(datasheet_id)
+
+        updated = [r.to_dict() for r in result]
+        publish_changes(datasheet_id, [
+            {'type': 'update', 'record_id': r.get('recordId'), 'record': r} for r in updated
+        ])
 
         logger.info(f"更新记录成功: {datasheet_id}, 数量: {len(request.records)}")
         
         return {
             "success": True,
-            "data": [r.to_dict() for r in result]
+            "data": updated
         }
         
     except Exception as e:
@@ -366,11 +1269,13 @@ async def delete_record(
         datasheet = vika.datasheet(datasheet_id)
         
         # 调用astral_vika的正确API
-        result = await datasheet.records.adelete(records=[record_id])
+        with invalidate_on_failure(datasheet_id):
+            result = await datasheet.records.adelete(records=[record_id])
         
         # 清除相关缓存
-        clear_cache_pattern(f"record:{datasheet_id}:{record_id}")
-        clear_cache_pattern(f"records:{datasheet_id}")
+        invalidate_datasheet_cache(datasheet_id)
+        
+        publish_changes(datasheet_id, [{'type': 'delete', 'record_id': record_id, 'record': None}])
         
         logger.info(f"删除记录成功: {datasheet_id}/{record_id}")
         
@@ -461,7 +1366,8 @@ async def _fetch_children_recursively(space, nodes: List[Any]) -> List[Dict[str,
             qps_limit = config.get('rate_limit_qps', 2)
             if qps_limit > 0:
                 delay = 1.0 / qps_limit
-                await asyncio.sleep(delay)
+                with trace_span("rate_limit_wait"):
+                    await asyncio.sleep(delay)
             
             logger.info(f"Node {node.id} is a folder. Fetching details...")
             folder_details = await space.nodes.aget(node.id)
@@ -491,18 +1397,22 @@ async def get_datasheets(
         if cached_result is not None:
             return {"success": True, "data": cached_result, "from_cache": True}
         
-        space = vika.space(space_id)
-        # 1. 获取顶层节点
-        top_level_nodes = await space.nodes.aall()
-        logger.info(f"Found {len(top_level_nodes)} top-level nodes.")
+        async def crawl_nodes_tree():
+            space = vika.space(space_id)
+            # 1. 获取顶层节点
+            top_level_nodes = await space.nodes.aall()
+            logger.info(f"Found {len(top_level_nodes)} top-level nodes.")
         
-        # 2. 使用新的、正确的递归函数来填充整个节点树
-        logger.info("Starting recursive fetch of children.")
-        result_data = await _fetch_children_recursively(space, top_level_nodes)
+            # 2. 使用新的、正确的递归函数来填充整个节点树
+            logger.info("Starting recursive fetch of children.")
+            result_data = await _fetch_children_recursively(space, top_level_nodes)
         
-        # 3. 序列化并缓存结果
-        # _fetch_children_recursively 现在直接返回字典列表
-        set_cache(cache_key, result_data)
+            # 3. 序列化并缓存结果
+            # _fetch_children_recursively 现在直接返回字典列表
+            set_cache(cache_key, result_data)
+            return result_data
+
+        result_data = await run_single_flight(cache_key, crawl_nodes_tree)
         
         logger.info(f"Returning full tree with {len(result_data)} root nodes.")
         return {
@@ -582,49 +1492,47 @@ async def get_space_configuration(
         if cached_result is not None:
             return {"success": True, "data": cached_result, "from_cache": True}
         
-        # 并行获取空间站信息和数据表列表
-        space = vika.space(space_id)
-        space_info_task = space.aget_space_info()
-        datasheets_task = space.datasheets.alist()
-        
-        space_info, datasheets_list = await asyncio.gather(
-            space_info_task,
-            datasheets_task
-        )
-        
-        # 为每个数据表并行获取详细信息
-        datasheet_tasks = []
-        for ds in datasheets_list:
-            datasheet = vika.datasheet(ds['id'])
-            views_task = datasheet.views.aall()
-            fields_task = datasheet.fields.aall()
-            datasheet_tasks.append((ds, views_task, fields_task))
-        
-        # 等待所有任务完成
-        datasheet_details = []
-        for ds, views_task, fields_task in datasheet_tasks:
-            try:
-                views, fields = await asyncio.gather(views_task, fields_task)
-                datasheet_details.append({
-                    **ds,
-                    'views': views.get('views', []),
-                    'fields': fields.get('fields', [])
-                })
-            except Exception as e:
-                logger.warning(f"获取数据表详情失败 {ds['id']}: {e}")
-                datasheet_details.append({
-                    **ds,
-                    'views': [],
-                    'fields': []
-                })
-        
-        result = {
-            'space': space_info,
-            'datasheets': datasheet_details
-        }
+        async def fetch_space_configuration():
+            # 并行获取空间站信息和数据表列表
+            space = vika.space(space_id)
+            space_info_task = space.aget_space_info()
+            datasheets_task = space.datasheets.alist()
+        
+            space_info, datasheets_list = await asyncio.gather(
+                space_info_task,
+                datasheets_task
+            )
+        
+            # 逐个数据表并行获取视图和字段（协程按需创建，请求被取消时不会留下未执行的上游调用）
+            datasheet_details = []
+            for ds in datasheets_list:
+                datasheet = vika.datasheet(ds['id'])
+                try:
+                    views, fields = await asyncio.gather(datasheet.views.aall(), datasheet.fields.aall())
+                    datasheet_details.append({
+                        **ds,
+                        'views': views.get('views', []),
+                        'fields': fields.get('fields', [])
+                    })
+                except Exception as e:
+                    logger.warning(f"获取数据表详情失败 {ds['id']}: {e}")
+                    datasheet_details.append({
+                        **ds,
+                        'views': [],
+                        'fields': []
+                    })
+        
+            result = {
+                'space': space_info,
+                'datasheets': datasheet_details
+            }
         
-        # 设置缓存
-        set_cache(cache_key, result)
+            # 设置缓存
+            set_cache(cache_key, result)
+            return result
+
+        result = await run_single_flight(cache_key, fetch_space_configuration)
+        datasheet_details = result['datasheets']
         
         logger.info(f"获取空间站配置成功: {space_id}, 数据表数量: {len(datasheet_details)}")
         
@@ -638,6 +1546,398 @@ async def get_space_configuration(
         logger.error(f"获取空间站配置失败: {e}")
         raise HTTPException(status_code=500, detail=f"获取空间站配置失败: {str(e)}")
 
+@app.get("/datasheets/{datasheet_id}/changes")
+async def get_changes(
+    datasheet_id: str,
+    request: Request,
+    since: int = 0,
+    epoch: Optional[str] = None,
+    stream: bool = False,
+    timeout: float = 25.0
+):
+    """
+    获取数据表的记录级变更流。
+    默认为长轮询：没有新事件时最多等待 timeout 秒；
+    stream=true 或 Accept: text/event-stream 时以SSE方式持续推送。
+    epoch 为上次响应中的服务实例标识，与当前实例不一致时返回 reset=True。
+    """
+    wants_sse = stream or "text/event-stream" in request.headers.get("accept", "")
+
+    if not wants_sse:
+        changes = get_changes_since(datasheet_id, since, epoch)
+        if not changes['events'] and not changes['reset'] and timeout > 0:
+            notify = _get_change_feed(datasheet_id)['notify']
+            try:
+                await asyncio.wait_for(notify.wait(), timeout=min(timeout, 60.0))
+            except asyncio.TimeoutError:
+                pass
+            changes = get_changes_since(datasheet_id, since, epoch)
+        return {"success": True, "data": changes}
+
+    # 断线重连时 EventSource 会带上最后收到的事件ID（格式为 epoch:version）；
+    # 无法解析时视为来自未知实例，要求全量重载
+    last_event_id = request.headers.get("last-event-id")
+    if last_event_id:
+        last_epoch, _, last_version = last_event_id.rpartition(":")
+        if last_epoch and last_version.isdigit():
+            epoch, since = last_epoch, int(last_version)
+        else:
+            epoch = ""
+
+    async def event_stream():
+        cursor = since
+        # 先告知当前的 epoch/version，便于消费方判断是否需要全量重载
+        changes = get_changes_since(datasheet_id, cursor, epoch)
+        yield f"event: hello\ndata: {json.dumps({k: changes[k] for k in ('epoch', 'version', 'reset')})}\n\n"
+        if changes['reset']:
+            cursor = changes['version']
+        while True:
+            if await request.is_disconnected():
+                break
+            for event in changes['events']:
+                yield f"id: {feed_epoch}:{event['version']}\nevent: {event['type']}\ndata: {json.dumps(event, ensure_ascii=False, default=str)}\n\n"
+                cursor = event['version']
+            # 上面的 await/yield 期间可能已有新事件发布并替换了 notify，此时直接进入下一轮
+            feed = _get_change_feed(datasheet_id)
+            if feed['version'] <= cursor:
+                try:
+                    await asyncio.wait_for(feed['notify'].wait(), timeout=15.0)
+                except asyncio.TimeoutError:
+                    # 心跳，保持连接不被中间代理断开
+                    yield ": keepalive\n\n"
+            changes = get_changes_since(datasheet_id, cursor)
+            if changes['reset']:
+                yield f"event: reset\ndata: {json.dumps({'epoch': changes['epoch'], 'version': changes['version']})}\n\n"
+                cursor = changes['version']
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+async def _build_search_index(datasheet_id: str) -> SearchIndex:
+    """
+    由全量快照构建全文索引并登记到 search_indexes。
+    快照落后于变更流时补放其后的事件（包括构建期间新发布的事件）；
+    所需事件已不在保留窗口内、或没有可用快照时，从上游重新拉取快照。
+    """
+    snapshot_key = full_snapshot_key(datasheet_id)
+    snapshot = get_from_cache(snapshot_key, max_age=SEARCH_INDEX_MAX_AGE)
+    for attempt in range(2):
+        if snapshot is None or attempt:
+            await rate_limit_check("search")
+            snapshot = await fetch_records_snapshot(await get_vika_client(), datasheet_id)
+        entry = cache.get(snapshot_key)
+        snapshot_timestamp = entry['timestamp'] if entry and entry['data'] is snapshot else time.time()
+
+        t0 = time.perf_counter()
+        index = await asyncio.to_thread(SearchIndex.from_snapshot, snapshot)
+        index.snapshot_timestamp = snapshot_timestamp
+        changes = get_changes_since(datasheet_id, snapshot.feed_version)
+        if changes['reset']:
+            logger.info(f"快照 {datasheet_id} 之后的变更已不在保留窗口内，重新拉取")
+            continue
+        for event in changes['events']:
+            index.apply(event)
+        search_indexes[datasheet_id] = index
+        logger.info(
+            f"构建全文索引: {datasheet_id}, 记录数: {len(index.doc_terms)}, "
+            f"补放事件: {len(changes['events'])}, 耗时: {time.perf_counter() - t0:.3f}s"
+        )
+        return index
+    raise HTTPException(status_code=503, detail=f"数据表 {datasheet_id} 变更过于频繁，索引构建失败，请稍后重试")
+
+@app.get("/datasheets/{datasheet_id}/search")
+async def search_records(
+    datasheet_id: str,
+    q: str,
+    limit: int = 20,
+    fields: Optional[str] = None
+):
+    """
+    在数据表快照上做全文检索。
+    索引在首次检索时由缓存的全量快照构建（没有可用快照时从上游拉取），之后随变更流增量更新，
+    快照过期后重新构建。
+    """
+    t0 = time.perf_counter()
+    index = search_indexes.get(datasheet_id)
+    if index is None or time.time() - index.snapshot_timestamp > SEARCH_INDEX_MAX_AGE:
+        index = await run_single_flight(
+            f"search_index:{datasheet_id}",
+            lambda: _build_search_index(datasheet_id)
+        )
+
+    field_list = fields.split(',') if fields else None
+    result = index.search(q, limit=max(1, min(limit, 200)), fields=field_list)
+    for item in result["results"]:
+        item["fields"] = index.texts.get(item["record_id"], {})
+
+    return {
+        "success": True,
+        "data": {
+            "query": q,
+            **result,
+            "took_ms": round((time.perf_counter() - t0) * 1000, 3),
+            "index": {
+                "docs": len(index.doc_terms),
+                "terms": len(index.postings),
+                "built_at": index.built_at,
+                "updated_at": index.updated_at,
+                "snapshot_at": index.snapshot_timestamp
+            }
+        }
+    }
+
+# 维格表单次写入接口最多处理10条记录
+UPSERT_BATCH_SIZE = 10
+
+def _is_empty_value(value: Any) -> bool:
+    """维格表不返回空字段，None/空串/空列表都视为“没有值”"""
+    return value is None or value is _MISSING or value == "" or value == []
+
+def _normalize_value(value: Any) -> Any:
+    """字段值比较前的规范化：数字统一为浮点，字符串去首尾空白，字符串列表忽略顺序"""
+    if isinstance(value, bool):
+        return value
+    if isinstance(value, (int, float)):
+        return float(value)
+    if isinstance(value, str):
+        return value.strip()
+    if isinstance(value, list):
+        items = [_normalize_value(v) for v in value]
+        if all(isinstance(v, str) for v in items):
+            return sorted(items)
+        return items
+    if isinstance(value, dict):
+        return {k: _normalize_value(v) for k, v in value.items()}
+    return value
+
+def values_equal(current: Any, desired: Any) -> bool:
+    """字段级比较，判断是否需要更新"""
+    if _is_empty_value(current) and _is_empty_value(desired):
+        return True
+    return _normalize_value(current) == _normalize_value(desired)
+
+def _upsert_key(value: Any) -> Optional[str]:
+    """将键字段的值转换为可比较的字符串"""
+    if _is_empty_value(value):
+        return None
+    return json.dumps(_normalize_value(value), sort_keys=True, ensure_ascii=False)
+
+async def _write_in_batches(items: List[Any], submit, pacing: Dict[str, float]) -> bool:
+    """
+    按单次写入上限分批提交，批次之间按QPS间隔。
+    pacing 记录上一次提交的时间（last_submit），在多次调用间共享，
+    使创建、更新、删除几组写入之间同样保持间隔。
+    items 中每项为元组，第一个元素是该行的结果字典；
+    submit(batch) 失败时只影响该批次，错误写回该批次各行的结果。
+    剩余时间不足以完成下一次限速等待时停止提交，其余各行标记为错误并返回已完成的部分。
+    返回是否有批次提交失败（失败的批次在上游可能已部分生效）。
+    """
+    failed = False
+    qps_limit = config.get('rate_limit_qps', 2)
+    for start in range(0, len(items), UPSERT_BATCH_SIZE):
+        batch = items[start:start + UPSERT_BATCH_SIZE]
+        last_submit = pacing.get("last_submit")
+        if last_submit is not None:
+            delay = max(0.0, last_submit + 1.0 / qps_limit - time.monotonic()) if qps_limit > 0 else 0.0
+            if not _deadline_allows(delay):
+                logger.warning(f"剩余时间不足, 未提交 {len(items) - start} 条")
+                for item in items[start:]:
+                    item[0]["action"] = "error"
+                    item[0]["error"] = "请求截止时间前无法完成，未提交"
+                return failed
+            if delay > 0:
+                with trace_span("rate_limit_wait"):
+                    await asyncio.sleep(delay)
+        pacing["last_submit"] = time.monotonic()
+        try:
+            await submit(batch)
+        except Exception as e:
+            logger.warning(f"批量写入失败, 本批 {len(batch)} 条: {e}")
+            failed = True
+            for item in batch:
+                item[0]["action"] = "error"
+                item[0]["error"] = str(e)
+    return failed
+
+@app.post("/datasheets/{datasheet_id}/upsert")
+async def upsert_records(
+    datasheet_id: str,
+    request: UpsertRequest,
+    vika: Vika = Depends(get_vika_client),
+    _: None = Depends(rate_limit_check)
+):
+    """
+    按键字段批量 upsert：与当前数据比对后只提交有变化的记录和字段。
+    当前数据优先取缓存中的全量快照（快照之后没有写入时），否则拉取一次全量。
+    """
+    try:
+        snapshot_key = get_cache_key(
+            "records_all",
+            datasheet_id=datasheet_id,
+            view_id=None,
+            filter_formula=None,
+            fields=None
+        )
+        snapshot = get_from_cache(snapshot_key, max_age=300)
+        from_cache = snapshot is not None and snapshot.feed_version == _get_change_feed(datasheet_id)['version']
+        if not from_cache:
+            snapshot = await fetch_records_snapshot(vika, datasheet_id)
+        # 写回时沿用快照原本的缓存时间，持续写入不会让快照永不过期
+        snapshot_entry = cache.get(snapshot_key)
+        snapshot_timestamp = snapshot_entry['timestamp'] if snapshot_entry else time.time()
+
+        # 以键字段建立当前记录索引，数据表中重复的键不参与自动匹配
+        current_by_key: Dict[str, int] = {}
+        duplicate_keys = set()
+        for row, value in enumerate(snapshot.columns.get(request.key_field, [])):
+            key = _upsert_key(value)
+            if key is None:
+                continue
+            if key in current_by_key:
+                duplicate_keys.add(key)
+            else:
+                current_by_key[key] = row
+
+        outcomes = []
+        to_create = []
+        to_update = []
+        seen_keys = set()
+        for index, fields in enumerate(request.rows):
+            outcome = {"index": index, "key": fields.get(request.key_field), "action": None, "record_id": None}
+            outcomes.append(outcome)
+            key = _upsert_key(fields.get(request.key_field))
+            if key is None:
+                outcome.update(action="error", error=f"缺少键字段 {request.key_field} 的值")
+                continue
+            if key in seen_keys:
+                outcome.update(action="error", error="请求中存在重复的键")
+                continue
+            seen_keys.add(key)
+            if key in duplicate_keys:
+                outcome.update(action="error", error="数据表中存在多条相同键的记录")
+                continue
+
+            row = current_by_key.get(key)
+            if row is None:
+                outcome["action"] = "created"
+                to_create.append((outcome, fields))
+                continue
+
+            outcome["record_id"] = snapshot.record_ids[row]
+            changed = {
+                name: value for name, value in fields.items()
+                if not values_equal(snapshot.columns[name][row] if name in snapshot.columns else _MISSING, value)
+            }
+            if changed:
+                outcome.update(action="updated", changed_fields=list(changed))
+                to_update.append((outcome, row, changed))
+            else:
+                outcome["action"] = "unchanged"
+
+        deleted = []
+        if request.delete_missing:
+            for key, row in current_by_key.items():
+                if key not in seen_keys and key not in duplicate_keys:
+                    outcome = {
+                        "key": snapshot.columns[request.key_field][row],
+                        "action": "deleted",
+                        "record_id": snapshot.record_ids[row]
+                    }
+                    deleted.append((outcome, None))
+
+        changes: List[Dict[str, Any]] = []
+        if not request.dry_run:
+            datasheet = vika.datasheet(datasheet_id)
+
+            async def submit_create(batch):
+                result = await datasheet.records.acreate(records=[fields for _, fields in batch])
+                for (outcome, _), record in zip(batch, result):
+                    record_dict = record.to_dict()
+                    outcome["record_id"] = record_dict.get("recordId")
+                    changes.append({'type': 'create', 'record_id': outcome["record_id"], 'record': record_dict})
+
+            async def submit_update(batch):
+                result = await datasheet.records.aupdate(records=[
+                    {'recordId': outcome["record_id"], 'fields': changed} for outcome, _, changed in batch
+                ])
+                updated = {}
+                for record in result or []:
+                    record_dict = record.to_dict()
+                    updated[record_dict.get("recordId")] = record_dict
+                for outcome, row, changed in batch:
+                    # 优先使用上游返回的记录（包含公式等服务端计算字段），没有返回时以快照中的原记录合并变更字段
+                    record_dict = updated.get(outcome["record_id"])
+                    if record_dict is None:
+                        record_dict = snapshot.row_dict(row)
+                        for name, value in changed.items():
+                            if _is_empty_value(value):
+                                record_dict['fields'].pop(name, None)
+                            else:
+                                record_dict['fields'][name] = value
+                    changes.append({'type': 'update', 'record_id': outcome["record_id"], 'record': record_dict})
+
+            async def submit_delete(batch):
+                await datasheet.records.adelete(records=[outcome["record_id"] for outcome, _ in batch])
+                for outcome, _ in batch:
+                    changes.append({'type': 'delete', 'record_id': outcome["record_id"], 'record': None})
+
+            async def write_all():
+                failed = False
+                pacing: Dict[str, float] = {}
+                try:
+                    with invalidate_on_failure(datasheet_id):
+                        for items, submit in ((to_create, submit_create), (to_update, submit_update), (deleted, submit_delete)):
+                            if items and await _write_in_batches(items, submit, pacing):
+                                failed = True
+                finally:
+                    # 中途失败时也发布已确认的写入，变更流与上游保持一致
+                    if changes:
+                        publish_changes(datasheet_id, changes)
+
+                if failed:
+                    # 失败的批次在上游可能已部分生效，快照不再可信
+                    invalidate_datasheet_cache(datasheet_id, drop_index=True)
+                elif changes:
+                    # 视图/过滤快照与单条记录缓存已过时，全量快照则直接同步写入结果，下一次 upsert 无需重新拉取
+                    invalidate_datasheet_cache(datasheet_id, keep=snapshot_key)
+                    feed_version = _get_change_feed(datasheet_id)['version']
+                    set_cache(snapshot_key, snapshot.apply_changes(changes, feed_version), timestamp=snapshot_timestamp)
+
+            # 写入阶段不随请求一起取消（截止时间或客户端断开）：已发出的批次要等上游返回，
+            # 登记结果并同步缓存快照，否则重试会基于过时的快照重复创建记录。
+            # 截止时间仍在批次之间生效（见 _write_in_batches）
+            write_task = asyncio.ensure_future(write_all())
+            _shielded_writes.add(write_task)
+            write_task.add_done_callback(_shielded_writes.discard)
+            await asyncio.shield(write_task)
+
+        deleted_outcomes = [outcome for outcome, _ in deleted]
+        summary = {"created": 0, "updated": 0, "unchanged": 0, "deleted": 0, "error": 0}
+        for outcome in outcomes + deleted_outcomes:
+            summary[outcome["action"]] += 1
+
+        usage = request_usage.get()
+        logger.info(f"upsert完成: {datasheet_id}, {summary}, dry_run: {request.dry_run}")
+
+        return {
+            "success": True,
+            "data": {
+                "summary": summary,
+                "dry_run": request.dry_run,
+                "snapshot_from_cache": from_cache,
+                "upstream_calls": usage["upstream_calls"] if usage is not None else None,
+                "rows": outcomes,
+                "deleted": deleted_outcomes
+            }
+        }
+
+    except Exception as e:
+        logger.error(f"upsert失败: {e}")
+        raise HTTPException(status_code=500, detail=f"upsert失败: {str(e)}")
+
 @app.post("/batch")
 async def batch_operations(
     request: BatchOperation,
@@ -655,17 +1955,31 @@ async def batch_operations(
             try:
                 if op_type == 'create_record':
                     datasheet = vika.datasheet(op_data['datasheet_id'])
-                    result = await datasheet.records.acreate(records=op_data['records'])
-                    results.append({'success': True, 'data': [r.to_dict() for r in result]})
+                    with invalidate_on_failure(op_data['datasheet_id']):
+                        result = await datasheet.records.acreate(records=op_data['records'])
+                    created = [r.to_dict() for r in result]
+                    publish_changes(op_data['datasheet_id'], [
+                        {'type': 'create', 'record_id': r.get('recordId'), 'record': r} for r in created
+                    ])
+                    results.append({'success': True, 'data': created})
                     
                 elif op_type == 'update_record':
                     datasheet = vika.datasheet(op_data['datasheet_id'])
-                    result = await datasheet.records.aupdate(records=op_data['records'])
-                    results.append({'success': True, 'data': [r.to_dict() for r in result]})
+                    with invalidate_on_failure(op_data['datasheet_id']):
+                        result = await datasheet.records.aupdate(records=op_data['records'])
+                    updated = [r.to_dict() for r in result]
+                    publish_changes(op_data['datasheet_id'], [
+                        {'type': 'update', 'record_id': r.get('recordId'), 'record': r} for r in updated
+                    ])
+                    results.append({'success': True, 'data': updated})
                     
                 elif op_type == 'delete_record':
                     datasheet = vika.datasheet(op_data['datasheet_id'])
-                    result = await datasheet.records.adelete(records=op_data['record_ids'])
+                    with invalidate_on_failure(op_data['datasheet_id']):
+                        result = await datasheet.records.adelete(records=op_data['record_ids'])
+                    publish_changes(op_data['datasheet_id'], [
+                        {'type': 'delete', 'record_id': rid, 'record': None} for rid in op_data['record_ids']
+                    ])
                     results.append({'success': True, 'data': result})
                     
                 else:
@@ -695,6 +2009,7 @@ async def clear_cache(pattern: Optional[str] = None):
             return {"success": True, "message": f"已清除匹配模式 '{pattern}' 的缓存"}
         else:
             cache.clear()
+            search_indexes.clear()
             return {"success": True, "message": "已清除所有缓存"}
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"清除缓存失败: {str(e)}")
@@ -705,20 +2020,224 @@ async def cache_stats():
     total_size = len(cache)
     size_by_type = {}
     
-    for key in cache.keys():
+    snapshot_memory = {
+        "snapshots": 0,
+        "rows": 0,
+        "dict_overhead_bytes": 0,
+        "compact_overhead_bytes": 0,
+        "saved_bytes": 0
+    }
+    
+    for key, entry in cache.items():
         cache_type = key.split(':')[0]
         size_by_type[cache_type] = size_by_type.get(cache_type, 0) + 1
+        if isinstance(entry['data'], RecordSnapshot):
+            snapshot_memory["snapshots"] += 1
+            for k, v in entry['data'].memory.items():
+                snapshot_memory[k] += v
+    
+    if snapshot_memory["dict_overhead_bytes"]:
+        snapshot_memory["reduction_ratio"] = round(
+            snapshot_memory["saved_bytes"] / snapshot_memory["dict_overhead_bytes"], 3
+        )
     
     return {
         "success": True,
         "data": {
             "total_size": total_size,
             "size_by_type": size_by_type,
-            "rate_limiter_stats": {k: len(v) for k, v in rate_limiter.items()}
+            "snapshot_memory": snapshot_memory,
+            "rate_limiter_stats": {k: len(v) for k, v in rate_limiter.items()},
+            "change_feeds": {
+                k: {"version": v['version'], "retained": len(v['events'])}
+                for k, v in change_feeds.items()
+            },
+            "search_indexes": {
+                k: {"docs": len(v.doc_terms), "terms": len(v.postings)}
+                for k, v in search_indexes.items()
+            },
+            "inflight_shared_calls": len(inflight_calls),
+            "cancellation_stats": cancellation_stats
+        }
+    }
+
+def _collapse_frame(frame) -> str:
+    """将调用栈转换为 collapsed 格式（根在前，以分号分隔）"""
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+def _sample_stacks(thread_id: int, interval: float, stop: threading.Event, samples: Counter):
+    """采样线程：定期抓取事件循环线程的调用栈"""
+    while not stop.wait(interval):
+        frame = sys._current_frames().get(thread_id)
+        if frame is not None:
+            samples[_collapse_frame(frame)] += 1
+
+def _stop_profile_session() -> Dict[str, Any]:
+    """结束当前剖析会话并保存结果"""
+    session = profile_session
+    if not session["running"]:
+        return session["result"]
+    session["running"] = False
+    timer = session.pop("timer", None)
+    if timer is not None and timer is not asyncio.current_task():
+        timer.cancel()
+
+    result = {
+        "mode": session["mode"],
+        "started_at": session["started_at"],
+        "duration_seconds": round(time.time() - session["started_at"], 3),
+        "profiler": None,
+        "collapsed": None
+    }
+    if session["mode"] == "cprofile":
+        profiler = session.pop("profiler")
+        profiler.disable()
+        result["profiler"] = profiler
+    else:
+        session.pop("stop_event").set()
+        session.pop("sampler").join(timeout=1.0)
+        samples = session.pop("samples")
+        result["samples"] = sum(samples.values())
+        result["collapsed"] = "\n".join(f"{stack} {count}" for stack, count in samples.most_common())
+    session["result"] = result
+    logger.info(f"性能剖析结束: {result['mode']}, 时长: {result['duration_seconds']}s")
+    return result
+
+async def _auto_stop_profile(seconds: float):
+    """到时自动结束剖析"""
+    await asyncio.sleep(seconds)
+    _stop_profile_session()
+
+def _profile_summary(result: Optional[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+    """剖析结果的元信息（不含数据本身）"""
+    if result is None:
+        return None
+    return {k: v for k, v in result.items() if k not in ("profiler", "collapsed")}
+
+@app.post("/admin/profile/start")
+async def start_profile(seconds: float = 30.0, mode: str = "cprofile", interval_ms: float = 5.0):
+    """
+    开始一次性能剖析，seconds 秒后自动结束。
+    mode=cprofile 使用确定性剖析（结果为pstats）；mode=sampling 定期采样事件循环线程的调用栈（结果为collapsed stacks）。
+    """
+    if profile_session["running"]:
+        raise HTTPException(status_code=409, detail="已有正在进行的剖析会话")
+    if mode not in ("cprofile", "sampling"):
+        raise HTTPException(status_code=400, detail=f"不支持的剖析模式: {mode}")
+    seconds = max(1.0, min(seconds, 600.0))
+
+    session = profile_session
+    if mode == "cprofile":
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError as e:
+            raise HTTPException(status_code=409, detail=f"无法启动cProfile: {e}")
+        session["profiler"] = profiler
+    else:
+        stop_event = threading.Event()
+        samples: Counter = Counter()
+        sampler = threading.Thread(
+            target=_sample_stacks,
+            args=(threading.get_ident(), max(interval_ms, 1.0) / 1000.0, stop_event, samples),
+            name="vika-profile-sampler",
+            daemon=True
+        )
+        sampler.start()
+        session.update(stop_event=stop_event, samples=samples, sampler=sampler)
+
+    session.update(running=True, mode=mode, started_at=time.time(), seconds=seconds)
+    session["timer"] = asyncio.create_task(_auto_stop_profile(seconds))
+    logger.info(f"性能剖析开始: {mode}, 时长: {seconds}s")
+    return {"success": True, "data": {"mode": mode, "seconds": seconds}}
+
+@app.post("/admin/profile/stop")
+async def stop_profile():
+    """提前结束当前剖析会话"""
+    if not profile_session["running"]:
+        raise HTTPException(status_code=409, detail="没有正在进行的剖析会话")
+    return {"success": True, "data": _profile_summary(_stop_profile_session())}
+
+@app.get("/admin/profile")
+async def get_profile_status():
+    """剖析会话状态"""
+    return {
+        "success": True,
+        "data": {
+            "running": profile_session["running"],
+            "mode": profile_session.get("mode") if profile_session["running"] else None,
+            "last_result": _profile_summary(profile_session["result"])
         }
     }
 
+@app.get("/admin/profile/result")
+async def download_profile(format: str = "pstats", limit: int = 60):
+    """
+    下载最近一次剖析结果。
+    cprofile: format=pstats（二进制，可用 pstats/snakeviz 打开）或 format=text；
+    sampling: format=collapsed（可直接交给 flamegraph.pl / speedscope）。
+    """
+    result = profile_session["result"]
+    if result is None:
+        raise HTTPException(status_code=404, detail="还没有剖析结果")
+    filename = f"vika-profile-{int(result['started_at'])}"
+
+    if result["mode"] == "cprofile":
+        if format == "pstats":
+            return Response(
+                content=marshal.dumps(pstats.Stats(result["profiler"]).stats),
+                media_type="application/octet-stream",
+                headers={"Content-Disposition": f'attachment; filename="{filename}.pstats"'}
+            )
+        if format == "text":
+            stream = io.StringIO()
+            pstats.Stats(result["profiler"], stream=stream).sort_stats("cumulative").print_stats(limit)
+            return Response(content=stream.getvalue(), media_type="text/plain; charset=utf-8")
+    elif format in ("collapsed", "text"):
+        return Response(
+            content=result["collapsed"],
+            media_type="text/plain; charset=utf-8",
+            headers={"Content-Disposition": f'attachment; filename="{filename}.collapsed"'}
+        )
+    raise HTTPException(status_code=400, detail=f"{result['mode']} 剖析结果不支持格式: {format}")
+
+@app.get("/admin/slow-requests")
+async def get_slow_requests(limit: int = 50):
+    """最近的慢请求及其耗时分段（最新的在前）"""
+    entries = list(slow_requests)[-max(limit, 0):] if limit else []
+    return {
+        "success": True,
+        "data": {
+            "threshold_ms": slow_request_config["threshold_ms"],
+            "capacity": slow_requests.maxlen,
+            "total": len(slow_requests),
+            "requests": entries[::-1]
+        }
+    }
+
+@app.put("/admin/slow-requests/config")
+async def set_slow_request_threshold(threshold_ms: float):
+    """调整慢请求阈值（毫秒）"""
+    slow_request_config["threshold_ms"] = max(0.0, threshold_ms)
+    return {"success": True, "data": slow_request_config}
+
+@app.delete("/admin/slow-requests")
+async def clear_slow_requests():
+    """清空慢请求日志"""
+    slow_requests.clear()
+    return {"success": True, "message": "已清空慢请求日志"}
+
+# 模块级初始化完成（不含SDK导入）
+_module_ready_t = time.perf_counter()
+
 if __name__ == "__main__":
+    import uvicorn
+
     # 从环境变量或配置文件读取设置
     port = int(os.environ.get("VIKA_SERVICE_PORT", 5001))
     host = os.environ.get("VIKA_SERVICE_HOST", "127.0.0.1")
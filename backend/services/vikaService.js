@@ -42,6 +42,10 @@ class VikaService {
       // 添加请求拦截器用于日志
       this.apiClient.interceptors.request.use(
         (config) => {
+          // 将本次调用的超时作为截止时间传给Python服务，超时放弃的请求在服务端也会被取消
+          if (config.timeout && !config.headers['X-Deadline-Ms']) {
+            config.headers['X-Deadline-Ms'] = String(config.timeout);
+          }
           const requestInfo = {
             method: config.method?.toUpperCase(),
             url: config.url,
@@ -341,7 +345,54 @@ class VikaService {
       };
     }
   }
-  
+
+  // 按键字段批量upsert：服务端比对当前数据，只提交有变化的记录和字段
+  // options: { deleteMissing: 是否删除未出现在rows中的记录, dryRun: 只计算不写入 }
+  async upsertRecords(datasheetId, keyField, rows, options = {}) {
+    logger.info('正在向维格表批量upsert记录', { datasheetId, keyField, count: rows.length });
+    try {
+      await this.ensureInitialized();
+
+      const response = await this.apiClient.post(`/datasheets/${datasheetId}/upsert`, {
+        key_field: keyField,
+        rows,
+        delete_missing: options.deleteMissing || false,
+        dry_run: options.dryRun || false
+      });
+
+      // Python服务在upsert后自行同步该表的缓存，这里无需再清除
+      return this.handleApiResponse(response, `批量upsert记录: ${datasheetId}`);
+
+    } catch (error) {
+      logger.error(`批量upsert记录失败: ${datasheetId}`, { error: error.message });
+      return {
+        success: false,
+        error: error.message
+      };
+    }
+  }
+
+  // 获取数据表变更（长轮询）
+  // 返回 { epoch, version, reset, events }；传入上次响应的 epoch，reset 为 true 时应全量重新获取记录
+  async getChanges(datasheetId, since = 0, epoch = null, waitSeconds = 25) {
+    try {
+      await this.ensureInitialized();
+
+      const params = { since, timeout: waitSeconds };
+      if (epoch) params.epoch = epoch;
+      const response = await this.apiClient.get(`/datasheets/${datasheetId}/changes`, { params });
+
+      return this.handleApiResponse(response, `获取数据表变更: ${datasheetId}`);
+
+    } catch (error) {
+      logger.error(`获取数据表变更失败: ${datasheetId}`, { error: error.message });
+      return {
+        success: false,
+        error: error.message
+      };
+    }
+  }
+
   // 获取空间站信息
   async getSpaceInfo(spaceId) {
     const cacheKey = `spaceInfo:${spaceId}`;